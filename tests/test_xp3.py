@@ -0,0 +1,233 @@
+import os
+import struct
+import sys
+import tempfile
+import types
+import unittest
+import zlib
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import xp3
+
+
+def build_chunk(name, data):
+    return xp3.CHUNK_HEADER.pack(name, len(data)) + data
+
+
+def build_xp3(files, compress_index=True, index_prefix=b'', extra_file_chunks=b''):
+    header_size = len(xp3.XP3_MAGIC) + xp3.UINT64_LE.size
+    body = bytearray()
+    index = bytearray(index_prefix)
+    for file_name, segments in files:
+        segment_records = bytearray()
+        file_data = b''
+        for compressed, data in segments:
+            stored_data = zlib.compress(data) if compressed else data
+            segment_records += xp3.SEGMENT_RECORD.pack(int(compressed), header_size + len(body),
+                                                       len(data), len(stored_data))
+            body += stored_data
+            file_data += data
+        encoded_name = file_name.encode('utf-16-le')
+        info = xp3.INFO_HEADER.pack(0, len(file_data), len(file_data), len(encoded_name) // 2) + encoded_name
+        section = build_chunk(b'info', info) + extra_file_chunks
+        section += build_chunk(b'segm', segment_records)
+        section += build_chunk(b'adlr', struct.pack('<I', zlib.adler32(file_data)))
+        index += build_chunk(b'File', section)
+
+    header = xp3.XP3_MAGIC + xp3.UINT64_LE.pack(header_size + len(body))
+    if compress_index:
+        compressed_index = zlib.compress(bytes(index))
+        file_manager = xp3.COMPRESSED_FILE_MANAGER_HEADER.pack(1, len(compressed_index), len(index))
+        file_manager += compressed_index
+    else:
+        file_manager = xp3.FILE_MANAGER_HEADER.pack(0, len(index)) + index
+    return header + bytes(body) + file_manager
+
+
+class XP3ParserTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+
+    def write_archive(self, files, compress_index=True, index_prefix=b'', extra_file_chunks=b''):
+        xp3_path = os.path.join(self.temp_dir.name, 'data.xp3')
+        with open(xp3_path, 'wb') as f:
+            f.write(build_xp3(files, compress_index, index_prefix, extra_file_chunks))
+        return xp3_path
+
+    def test_extract(self):
+        files = [
+            ('system/Config.tjs', [(True, b'config' * 100)]),
+            ('image/bg.tlg', [(False, b'a' * 300), (False, b'b' * 200), (True, b'c' * 500)]),
+            ('empty.txt', []),
+        ]
+        output_dir = os.path.join(self.temp_dir.name, 'out')
+        with xp3.XP3Parser(self.write_archive(files)) as parser:
+            parser.extract(output_dir, verify_checksum=True)
+        for file_name, segments in files:
+            with open(os.path.join(output_dir, file_name), 'rb') as f:
+                self.assertEqual(f.read(), b''.join(data for _, data in segments))
+
+    def assert_extracts(self, xp3_path, files):
+        output_dir = os.path.join(self.temp_dir.name, 'out')
+        with xp3.XP3Parser(xp3_path) as parser:
+            self.assertEqual([file.file_name for file in parser.file_manager], [name for name, _ in files])
+            parser.extract(output_dir, verify_checksum=True)
+        for file_name, segments in files:
+            with open(os.path.join(output_dir, file_name), 'rb') as f:
+                self.assertEqual(f.read(), b''.join(data for _, data in segments))
+
+    def test_skips_unknown_index_chunk(self):
+        files = [('a.txt', [(True, b'a' * 100)]), ('b.txt', [(False, b'b' * 100)])]
+        for compress_index in (True, False):
+            xp3_path = self.write_archive(files, compress_index, index_prefix=build_chunk(b'Junk', b'File' * 4))
+            self.assert_extracts(xp3_path, files)
+
+    def test_resyncs_after_truncated_index_chunk(self):
+        files = [('a.txt', [(True, b'a' * 100)]), ('b.txt', [(False, b'b' * 100)])]
+        index_prefix = xp3.CHUNK_HEADER.pack(b'Junk', 1 << 40) + b'garbage'
+        for compress_index in (True, False):
+            self.assert_extracts(self.write_archive(files, compress_index, index_prefix), files)
+
+    def test_skips_unknown_file_chunk(self):
+        data = b'a' * 100
+        files = [('a.txt', [(True, data)])]
+        xp3_path = self.write_archive(files, extra_file_chunks=build_chunk(b'time', b'segmadlr'))
+        self.assert_extracts(xp3_path, files)
+        with xp3.XP3Parser(xp3_path, lazy=True) as parser:
+            file = parser.get_file('a.txt')
+            self.assertEqual(len(file.segments), 1)
+            self.assertEqual(file.adlr, zlib.adler32(data))
+
+    def test_extract_without_kernel_copy(self):
+        data = [(False, b'a' * 300), (True, b'b' * 500), (False, b'c' * 200), (False, b'd' * 100)]
+        output_dir = os.path.join(self.temp_dir.name, 'out')
+        with xp3.XP3Parser(self.write_archive([('mixed.bin', data)])) as parser, \
+                mock.patch.object(xp3, 'KERNEL_COPY_FUNCTIONS', []):
+            parser.extract(output_dir, verify_checksum=True)
+        with open(os.path.join(output_dir, 'mixed.bin'), 'rb') as f:
+            self.assertEqual(f.read(), b''.join(segment_data for _, segment_data in data))
+
+    def test_extract_checksum_mismatch(self):
+        data = b'a' * 300 + b'b' * 500
+        adlr_chunk = xp3.CHUNK_HEADER.pack(b'adlr', 4) + struct.pack('<I', zlib.adler32(data))
+        bad_adlr_chunk = xp3.CHUNK_HEADER.pack(b'adlr', 4) + struct.pack('<I', zlib.adler32(data) ^ 1)
+        archive = build_xp3([('a.txt', [(False, b'a' * 300), (True, b'b' * 500)])], compress_index=False)
+        xp3_path = os.path.join(self.temp_dir.name, 'data.xp3')
+        with open(xp3_path, 'wb') as f:
+            f.write(archive.replace(adlr_chunk, bad_adlr_chunk))
+        output_dir = os.path.join(self.temp_dir.name, 'out')
+        with xp3.XP3Parser(xp3_path) as parser:
+            with self.assertRaisesRegex(ValueError, 'Invalid XP3 file checksum'):
+                parser.extract(output_dir, verify_checksum=True)
+            parser.extract(output_dir)
+
+    def test_extract_duplicate_names_keeps_last_entry(self):
+        first = bytes(range(256)) * (1 << 15)
+        last = bytes(reversed(range(256))) * (1 << 15)
+        files = [
+            ('same', [(False, first)]),
+            ('other', [(True, b'other')]),
+            ('same', [(False, last)]),
+        ]
+        xp3_path = self.write_archive(files)
+        output_dir = os.path.join(self.temp_dir.name, 'out')
+        for _ in range(5):
+            with xp3.XP3Parser(xp3_path) as parser:
+                parser.extract(output_dir, max_workers=2)
+            with open(os.path.join(output_dir, 'same'), 'rb') as f:
+                self.assertEqual(f.read(), last)
+
+    def test_extract_truncates_after_failed_preallocation(self):
+        def failing_fallocate(fd, offset, length):
+            os.ftruncate(fd, offset + length + 4096)
+            raise OSError('fallocate failed')
+
+        files = [('a.txt', [(False, b'a' * xp3.WRITE_BUFFER_SIZE), (True, b'b' * 100)])]
+        output_dir = os.path.join(self.temp_dir.name, 'out')
+        with xp3.XP3Parser(self.write_archive(files)) as parser, \
+                mock.patch.object(xp3.os, 'posix_fallocate', failing_fallocate, create=True):
+            parser.extract(output_dir)
+        with open(os.path.join(output_dir, 'a.txt'), 'rb') as f:
+            self.assertEqual(f.read(), b'a' * xp3.WRITE_BUFFER_SIZE + b'b' * 100)
+
+    def test_extract_truncates_after_failed_extraction(self):
+        stored_data = b'a' * xp3.WRITE_BUFFER_SIZE
+        compressed_data = b'b' * 100
+        archive = build_xp3([('a.txt', [(False, stored_data), (True, compressed_data)])])
+        archive = archive.replace(zlib.compress(compressed_data), bytes(len(zlib.compress(compressed_data))))
+        xp3_path = os.path.join(self.temp_dir.name, 'data.xp3')
+        with open(xp3_path, 'wb') as f:
+            f.write(archive)
+        output_dir = os.path.join(self.temp_dir.name, 'out')
+        with xp3.XP3Parser(xp3_path) as parser, self.assertRaises(zlib.error):
+            parser.extract(output_dir, max_workers=1)
+        self.assertEqual(os.path.getsize(os.path.join(output_dir, 'a.txt')), len(stored_data))
+
+    def test_extract_ignores_oversized_recorded_size(self):
+        data = b'compressed' * xp3.WRITE_BUFFER_SIZE
+        stored_data = zlib.compress(data)
+        segment_record = xp3.SEGMENT_RECORD.pack(1, 19, len(data), len(stored_data))
+        archive = build_xp3([('a.txt', [(True, data)])], compress_index=False)
+        xp3_path = os.path.join(self.temp_dir.name, 'data.xp3')
+        output_dir = os.path.join(self.temp_dir.name, 'out')
+        for recorded_size in (1 << 40, 1 << 63):
+            oversized_record = xp3.SEGMENT_RECORD.pack(1, 19, recorded_size, len(stored_data))
+            with open(xp3_path, 'wb') as f:
+                f.write(archive.replace(segment_record, oversized_record))
+            with xp3.XP3Parser(xp3_path) as parser:
+                parser.extract(output_dir, verify_checksum=True)
+            with open(os.path.join(output_dir, 'a.txt'), 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertLessEqual(os.stat(os.path.join(output_dir, 'a.txt')).st_blocks * 512, 2 * len(data))
+
+    def test_close_uncompressed_file_manager(self):
+        files = [('a.txt', [(False, b'aaa')]), ('b.txt', [(True, b'bbb')])]
+        xp3_path = self.write_archive(files, compress_index=False)
+        for lazy in (False, True):
+            parser = xp3.XP3Parser(xp3_path, lazy=lazy)
+            self.assertEqual([file.file_name for file in parser.file_manager], ['a.txt', 'b.txt'])
+            self.assertEqual(parser.get_file('b.txt').uncompressed_size, 3)
+            parser.close()
+            self.assertTrue(parser.xp3_mmap.closed)
+            self.assertTrue(parser.xp3_file.closed)
+
+
+class ShortWriteFile:
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = bytearray()
+        self.write_sizes = []
+
+    def fileno(self):
+        return -1
+
+    def write(self, buffer):
+        self.write_sizes.append(len(buffer))
+        written = min(len(buffer), self.limit)
+        self.data += buffer[:written]
+        return written
+
+
+class WriteBuffersTest(unittest.TestCase):
+    def test_fallback_handles_short_writes(self):
+        f_out = ShortWriteFile(7)
+        buffers = [b'first', bytearray(b'second'), memoryview(b'third' * 10), b'']
+        with mock.patch.object(xp3, 'os', types.SimpleNamespace()):
+            xp3.write_buffers(f_out, buffers)
+        self.assertEqual(f_out.data, b'firstsecond' + b'third' * 10)
+        self.assertEqual(buffers, [])
+
+    def test_splits_large_buffers(self):
+        f_out = ShortWriteFile(100)
+        with mock.patch.object(xp3, 'os', types.SimpleNamespace()), \
+                mock.patch.object(xp3, 'MAX_WRITE_SIZE', 16):
+            xp3.write_buffers(f_out, [bytes(range(50))])
+        self.assertEqual(f_out.data, bytes(range(50)))
+        self.assertLessEqual(max(f_out.write_sizes), 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
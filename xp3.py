@@ -1,216 +1,484 @@
+import codecs
 import ctypes
 import hashlib
+import operator
 import os
+import re
 import struct
-import zlib
+import sys
 import mmap
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from isal import isal_zlib as zlib
+except ImportError:
+    try:
+        from zlib_ng import zlib_ng as zlib
+    except ImportError:
+        import zlib
 
 W_CHAR_SIZE = ctypes.sizeof(ctypes.c_wchar)
+UTF16_LE_DECODE = codecs.getdecoder('utf-16-le')
+
+XP3_MAGIC = bytes.fromhex('58 50 33 0D 0A 20 0A 1A 8B 67 01')
+
+UINT32_LE = struct.Struct('<I')
+UINT64_LE = struct.Struct('<Q')
+FILE_MANAGER_HEADER = struct.Struct('<BQ')
+COMPRESSED_FILE_MANAGER_HEADER = struct.Struct('<BQQ')
+CHUNK_HEADER = struct.Struct('<4sQ')
+INFO_HEADER = struct.Struct('<IQQH')
+SEGMENT_RECORD = struct.Struct('<IQQQ')
+
+KRKR_230_MAGIC = UINT64_LE.unpack(bytes.fromhex('17 00 00 00 00 00 00 00'))[0]
+
+FILE_SECTION_PATTERN = re.compile(b'File')
+
+IOV_MAX = 1024
+WRITE_BUFFER_SIZE = 1 << 20
+MAX_WRITE_SIZE = 1 << 30
+MAX_DEFLATE_RATIO = 1032
+
+
+def decode_file_name(file_name_data):
+    try:
+        return UTF16_LE_DECODE(file_name_data)[0].rstrip('\x00')
+    except UnicodeDecodeError:
+        md5 = hashlib.md5()
+        md5.update(file_name_data)
+        return md5.hexdigest()
+
+
+def parse_info_chunk(entry, chunk):
+    info_size = len(chunk)
+
+    (protect_flag_value, info_uncompressed_size, info_storage_size,
+     info_file_name_length) = INFO_HEADER.unpack_from(chunk)
+    info_file_name_size = info_file_name_length * W_CHAR_SIZE
+
+    expected_info_size = INFO_HEADER.size + info_file_name_size
+
+    if info_size != expected_info_size:
+        info_file_name_size = info_size - INFO_HEADER.size
+
+    entry.protect_flag = (protect_flag_value & (1 << 31)) != 0
+    entry.uncompressed_size = info_uncompressed_size
+    entry.storage_size = info_storage_size
+    entry.file_name_data = bytes(chunk[INFO_HEADER.size:INFO_HEADER.size + info_file_name_size])
+
+
+def parse_adlr_chunk(entry, chunk):
+    if len(chunk) != 4:
+        raise ValueError('Invalid XP3 FileManager adlr checksum')
+    entry.adlr = UINT32_LE.unpack_from(chunk)[0]
+
+
+class FileEntry:
+    __slots__ = ('protect_flag', 'uncompressed_size', 'storage_size', 'file_name_data', '_file_name',
+                 'segments', 'adlr', 'section')
+
+    def __init__(self):
+        self.protect_flag = False
+        self.uncompressed_size = 0
+        self.storage_size = 0
+        self.file_name_data = None
+        self._file_name = None
+        self.segments = range(0)
+        self.adlr = None
+        self.section = None
+
+    @property
+    def file_name(self):
+        if self._file_name is None:
+            if self.file_name_data is None:
+                self._file_name = "unnamed_file"
+            else:
+                self._file_name = decode_file_name(self.file_name_data)
+        return self._file_name
+
+
+def write_buffers(f_out, buffers):
+    chunks = []
+    for buffer in buffers:
+        buffer = memoryview(buffer)
+        for start in range(0, len(buffer), MAX_WRITE_SIZE):
+            chunks.append(buffer[start:start + MAX_WRITE_SIZE])
+    buffers.clear()
+
+    fd = f_out.fileno()
+    while chunks:
+        if hasattr(os, 'writev'):
+            batch_size = len(chunks[0])
+            batch_count = 1
+            for chunk in chunks[1:IOV_MAX]:
+                if batch_size + len(chunk) > MAX_WRITE_SIZE:
+                    break
+                batch_size += len(chunk)
+                batch_count += 1
+            written = os.writev(fd, chunks[:batch_count])
+        else:
+            written = f_out.write(chunks[0])
+        written_chunks = 0
+        for chunk in chunks:
+            if written < len(chunk):
+                break
+            written -= len(chunk)
+            written_chunks += 1
+        del chunks[:written_chunks]
+        if written:
+            chunks[0] = chunks[0][written:]
+
+
+def copy_file_range(src_fd, dst_fd, offset, count):
+    return os.copy_file_range(src_fd, dst_fd, count, offset)
+
+
+def sendfile(src_fd, dst_fd, offset, count):
+    return os.sendfile(dst_fd, src_fd, offset, count)
+
+
+KERNEL_COPY_FUNCTIONS = []
+if hasattr(os, 'copy_file_range'):
+    KERNEL_COPY_FUNCTIONS.append(copy_file_range)
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    KERNEL_COPY_FUNCTIONS.append(sendfile)
+
+
+Segment = namedtuple('Segment', ['compressed_flag', 'offset', 'uncompressed_size', 'storage_size'])
+
+
+class SegmentTable:
+    def __init__(self):
+        self.compressed_flags = array('B')
+        self.offsets = array('Q')
+        self.uncompressed_sizes = array('Q')
+        self.storage_sizes = array('Q')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        return Segment(bool(self.compressed_flags[index]), self.offsets[index],
+                       self.uncompressed_sizes[index], self.storage_sizes[index])
+
+    def append_chunk(self, chunk):
+        start = len(self.offsets)
+        num_segments = len(chunk) // SEGMENT_RECORD.size
+        if num_segments == 0:
+            return range(start, start)
+
+        segm_records = SEGMENT_RECORD.iter_unpack(chunk[:num_segments * SEGMENT_RECORD.size])
+        compressed_flags, offsets, uncompressed_sizes, storage_sizes = zip(*segm_records)
+        compressed_flags = list(map(bool, compressed_flags))
+        stored_sizes_match = map(operator.eq, uncompressed_sizes, storage_sizes)
+        if any(map(operator.eq, compressed_flags, stored_sizes_match)):
+            raise ValueError('Invalid XP3 FileManager Segment')
+
+        self.compressed_flags.extend(compressed_flags)
+        self.offsets.extend(offsets)
+        self.uncompressed_sizes.extend(uncompressed_sizes)
+        self.storage_sizes.extend(storage_sizes)
+        return range(start, len(self.offsets))
 
 
 class XP3Parser:
-    def __init__(self, xp3_path: str):
+    def __init__(self, xp3_path: str, lazy: bool = False):
         if xp3_path is None:
             raise ValueError("xp3_path cannot be None")
         self.xp3_path = xp3_path
 
         self.xp3_file = open(self.xp3_path, 'rb')
         self.xp3_size = os.path.getsize(self.xp3_path)
-        self.xp3_data = mmap.mmap(self.xp3_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.xp3_mmap = mmap.mmap(self.xp3_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.xp3_data = self.xp3_mmap
 
-        header_signature = bytes.fromhex('58 50 33 0D 0A 20 0A 1A 8B 67 01')
-        index = self.xp3_data.find(header_signature)
+        index = self.xp3_mmap.find(XP3_MAGIC)
         if index == -1:
             raise ValueError('Invalid XP3 header')
         else:
+            self.xp3_offset = index
             if index != 0:
-                self.xp3_data = self.xp3_data[index:]
+                self.xp3_data = memoryview(self.xp3_mmap)[index:]
 
         self.file_manager_header_location = self.parse_xp3_header()
+        self.advise_data_access(self.file_manager_header_location)
 
         file_manager_header = self.parse_file_manager_header(self.file_manager_header_location)
         self.is_file_manager_compressed, self.file_manager_compressed_size, self.file_manager_size = file_manager_header
 
-        self.file_manager = self.get_file_manager(self.file_manager_header_location, *file_manager_header)
-        self.file_manager = self.parse_file_manager(self.file_manager)
+        file_manager_data = self.get_file_manager(self.file_manager_header_location, *file_manager_header)
+        self.segment_table = SegmentTable()
+        try:
+            file_manager = file_manager_data
+            if lazy and isinstance(file_manager_data, memoryview):
+                # Lazy sections outlive parsing, so they must not point into the mapping.
+                file_manager = file_manager_data.tobytes()
+            self.file_manager = self.parse_file_manager(file_manager, self.segment_table, lazy)
+        finally:
+            if isinstance(file_manager_data, memoryview):
+                file_manager_data.release()
+        self.file_index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def __del__(self):
-        if hasattr(self, 'xp3_data') and self.xp3_data:
-            self.xp3_data.close()
-        if hasattr(self, 'xp3_file') and self.xp3_file:
-            self.xp3_file.close()
+        self.close()
+
+    def close(self):
+        if isinstance(getattr(self, 'xp3_data', None), memoryview):
+            self.xp3_data.release()
+        try:
+            if hasattr(self, 'xp3_mmap') and not self.xp3_mmap.closed:
+                self.xp3_mmap.close()
+        finally:
+            if hasattr(self, 'xp3_file') and not self.xp3_file.closed:
+                self.xp3_file.close()
+
+    def advise_data_access(self, file_manager_header_location):
+        if not hasattr(self.xp3_mmap, 'madvise'):
+            return
+        start = self.xp3_offset - self.xp3_offset % mmap.PAGESIZE
+        end = min(self.xp3_offset + file_manager_header_location, len(self.xp3_mmap))
+        if end > start:
+            self.xp3_mmap.madvise(mmap.MADV_SEQUENTIAL, start, end - start)
 
     def parse_xp3_header(self):
-        if self.xp3_data[11:19] != bytes.fromhex('17 00 00 00 00 00 00 00'):
-            return struct.unpack("<Q", self.xp3_data[11:19])[0]
+        file_manager_header_location = UINT64_LE.unpack_from(self.xp3_data, 11)[0]
+        if file_manager_header_location != KRKR_230_MAGIC:
+            return file_manager_header_location
         else:
-            return struct.unpack("<Q", self.xp3_data[32:40])[0]
+            return UINT64_LE.unpack_from(self.xp3_data, 32)[0]
 
     def parse_file_manager_header(self, header_location):
         is_compressed = self.xp3_data[header_location] != 0
 
         if is_compressed:
-            compressed_size = struct.unpack("<Q", self.xp3_data[header_location + 1:header_location + 9])[0]
-            uncompressed_size = struct.unpack("<Q", self.xp3_data[header_location + 9:header_location + 17])[0]
+            _, compressed_size, uncompressed_size = COMPRESSED_FILE_MANAGER_HEADER.unpack_from(self.xp3_data,
+                                                                                             header_location)
         else:
             compressed_size = 0
-            uncompressed_size = struct.unpack("<Q", self.xp3_data[header_location + 1:header_location + 9])[0]
+            _, uncompressed_size = FILE_MANAGER_HEADER.unpack_from(self.xp3_data, header_location)
         return is_compressed, compressed_size, uncompressed_size
 
     def get_file_manager(self, header_location, is_compressed, compressed_size, uncompressed_size):
         if is_compressed:
-            compressed_data = self.xp3_data[header_location + 17:header_location + 17 + compressed_size]
-            decompressed = zlib.decompress(compressed_data)
+            compressed_start = header_location + COMPRESSED_FILE_MANAGER_HEADER.size
+            decompressor = zlib.decompressobj()
+            with memoryview(self.xp3_data)[compressed_start:compressed_start + compressed_size] as compressed_data:
+                decompressed = decompressor.decompress(compressed_data, uncompressed_size)
+            if not decompressor.eof:
+                raise ValueError('Invalid XP3 FileManager')
         else:
-            decompressed = self.xp3_data[header_location + 9:header_location + 9 + uncompressed_size]
+            data_start = header_location + FILE_MANAGER_HEADER.size
+            decompressed = memoryview(self.xp3_data)[data_start:data_start + uncompressed_size]
         if len(decompressed) != uncompressed_size:
             raise ValueError('Invalid XP3 FileManager')
         return decompressed
 
     @staticmethod
-    def parse_file_manager(file_manager: bytes):
+    def parse_file_manager(file_manager: bytes, segment_table: SegmentTable, lazy: bool = False):
         parsed_file_manager = []
+        chunk_parsers = XP3Parser.get_chunk_parsers(segment_table)
+        if lazy:
+            chunk_parsers = {b'info': chunk_parsers[b'info']}
+        file_manager_view = memoryview(file_manager)
+        chunk_header_size = CHUNK_HEADER.size
+        unpack_chunk_header = CHUNK_HEADER.unpack_from
         i = 0
         file_manager_length = len(file_manager)
-        while i < file_manager_length:
-            index = file_manager.find(b'File', i)
-            if index == -1:
-                break
-            else:
-                i = index + 4
-                if i + 8 > file_manager_length:
-                    raise ValueError('Unexpected end of file manager data')
-                file_manager_section_size = struct.unpack("<Q", file_manager[i:i + 8])[0]
-                i += 8
-                if i + file_manager_section_size > file_manager_length:
-                    raise ValueError('Unexpected end of file manager data')
-                file_manager_section = file_manager[i:i + file_manager_section_size]
-                parsed_file_manager_section = {}
-                j = 0
-                while j < file_manager_section_size:
-                    if file_manager_section[j:j + 4] == b'info':
-                        j += 4
-                        info_size = struct.unpack("<Q", file_manager_section[j:j + 8])[0]
-                        j += 8
-
-                        protect_flag_value = struct.unpack("<I", file_manager_section[j:j + 4])[0]
-                        info_protect_flag = (protect_flag_value & (1 << 31)) != 0
-                        j += 4
-
-                        info_uncompressed_size = struct.unpack("<Q", file_manager_section[j:j + 8])[0]
-                        j += 8
-
-                        info_storage_size = struct.unpack("<Q", file_manager_section[j:j + 8])[0]
-                        j += 8
-
-                        info_file_name_length = struct.unpack("<H", file_manager_section[j:j + 2])[0]
-                        info_file_name_size = info_file_name_length * W_CHAR_SIZE
-                        j += 2
-
-                        expected_info_size = 4 + 8 + 8 + 2 + info_file_name_size
-
-                        if info_size != expected_info_size:
-                            info_file_name_size = info_size - (4 + 8 + 8 + 2)
-
-                        info_file_name_data = file_manager_section[j:j + info_file_name_size]
-                        try:
-                            info_file_name = info_file_name_data.decode('utf-16-le').rstrip('\x00')
-                        except UnicodeDecodeError:
-                            md5 = hashlib.md5()
-                            md5.update(info_file_name_data)
-                            info_file_name = md5.hexdigest()
-                        j += info_file_name_size
-
-                        parsed_file_manager_section["info"] = {
-                            "size": info_size,
-                            "protect_flag": info_protect_flag,
-                            "uncompressed_size": info_uncompressed_size,
-                            "storage_size": info_storage_size,
-                            "file_name_size": info_file_name_size,
-                            "file_name": info_file_name
-                        }
-                    elif file_manager_section[j:j + 4] == b'segm':
-                        j += 4
-                        segm_size = struct.unpack("<Q", file_manager_section[j:j + 8])[0]
-                        j += 8
-
-                        num_segments = segm_size // (4 + 8 + 8 + 8)
-                        segm = []
-                        for _ in range(num_segments):
-                            segm_compressed_flag_value = struct.unpack("<I", file_manager_section[j:j + 4])[0]
-                            segm_compressed_flag = bool(segm_compressed_flag_value)
-                            j += 4
-
-                            segm_offset = struct.unpack("<Q", file_manager_section[j:j + 8])[0]
-                            j += 8
-
-                            segm_uncompressed_size = struct.unpack("<Q", file_manager_section[j:j + 8])[0]
-                            j += 8
-
-                            segm_storage_size = struct.unpack("<Q", file_manager_section[j:j + 8])[0]
-                            j += 8
-
-                            if segm_compressed_flag:
-                                if segm_uncompressed_size == segm_storage_size:
-                                    raise ValueError('Invalid XP3 FileManager Segment')
-                            else:
-                                if segm_uncompressed_size != segm_storage_size:
-                                    raise ValueError('Invalid XP3 FileManager Segment')
-
-                            segm.append({
-                                "compressed_flag": segm_compressed_flag,
-                                "offset": segm_offset,
-                                "uncompressed_size": segm_uncompressed_size,
-                                "storage_size": segm_storage_size
-                            })
-                        parsed_file_manager_section["segm"] = segm
-                    elif file_manager_section[j:j + 4] == b'adlr':
-                        j += 4
-                        adlr_size = struct.unpack("<Q", file_manager_section[j:j + 8])[0]
-                        j += 8
-                        if adlr_size != 4:
-                            raise ValueError('Invalid XP3 FileManager adlr checksum')
-                        adlr = struct.unpack("<I", file_manager_section[j:j + adlr_size])[0]
-                        j += adlr_size
-                        parsed_file_manager_section["adlr"] = {"size": adlr_size, "adlr": adlr}
-                    else:
-                        break
-                parsed_file_manager.append(parsed_file_manager_section)
-                i += file_manager_section_size
+        while i + chunk_header_size <= file_manager_length:
+            section_name, file_manager_section_size = unpack_chunk_header(file_manager_view, i)
+            i += chunk_header_size
+            if section_name != b'File':
+                if i + file_manager_section_size <= file_manager_length:
+                    i += file_manager_section_size
+                    continue
+                match = FILE_SECTION_PATTERN.search(file_manager_view, i - chunk_header_size + 1)
+                if match is None:
+                    break
+                i = match.start()
+                continue
+            if i + file_manager_section_size > file_manager_length:
+                raise ValueError('Unexpected end of file manager data')
+            file_manager_section = file_manager_view[i:i + file_manager_section_size]
+            entry = FileEntry()
+            XP3Parser.parse_file_section(file_manager_section, chunk_parsers, entry)
+            if lazy:
+                entry.section = file_manager_section
+            parsed_file_manager.append(entry)
+            i += file_manager_section_size
         return parsed_file_manager
 
-    def extract(self, output_dir: str = None):
+    @staticmethod
+    def get_chunk_parsers(segment_table: SegmentTable):
+        def parse_segm_chunk(entry, chunk):
+            entry.segments = segment_table.append_chunk(chunk)
+
+        return {
+            b'info': parse_info_chunk,
+            b'segm': parse_segm_chunk,
+            b'adlr': parse_adlr_chunk,
+        }
+
+    @staticmethod
+    def parse_file_section(file_manager_section, chunk_parsers, entry):
+        chunk_header_size = CHUNK_HEADER.size
+        unpack_chunk_header = CHUNK_HEADER.unpack_from
+        file_manager_section_size = len(file_manager_section)
+        j = 0
+        while j + chunk_header_size <= file_manager_section_size:
+            chunk_name, chunk_size = unpack_chunk_header(file_manager_section, j)
+            j += chunk_header_size
+            parse_chunk = chunk_parsers.get(chunk_name)
+            if parse_chunk is not None:
+                parse_chunk(entry, file_manager_section[j:j + chunk_size])
+            j += chunk_size
+
+    def load_file(self, file):
+        if file.section is not None:
+            chunk_parsers = self.get_chunk_parsers(self.segment_table)
+            del chunk_parsers[b'info']
+            self.parse_file_section(file.section, chunk_parsers, file)
+            file.section = None
+        return file
+
+    def get_file(self, file_name):
+        if self.file_index is None:
+            self.file_index = {file.file_name: file for file in self.file_manager}
+        return self.load_file(self.file_index[file_name])
+
+    def extract(self, output_dir: str = None, max_workers: int = None, verify_checksum: bool = False):
         if output_dir is None:
             output_dir = os.path.dirname(self.xp3_path)
             base_name = os.path.splitext(os.path.basename(self.xp3_path))[0]
             output_dir = os.path.join(output_dir, base_name)
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
 
-        for file in self.file_manager:
-            file_info = file.get("info", {})
-            file_name = file_info.get("file_name", "unnamed_file")
+        output_paths = [self.get_output_path(output_dir, file) for file in self.file_manager]
+        for output_subdir in {os.path.dirname(output_path) for output_path in output_paths}:
+            os.makedirs(output_subdir, exist_ok=True)
 
-            output_path = os.path.join(output_dir, file_name)
+        jobs = {}
+        for file, output_path in zip(self.file_manager, output_paths):
+            job_key = os.path.normcase(os.path.normpath(output_path)).casefold()
+            checksum = file.adlr if verify_checksum else None
+            jobs.setdefault(job_key, []).append((output_path, self.load_file(file).segments, checksum))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(self.extract_files, jobs.values()))
 
-            if len(output_path) > 260 or len(file_name) > 255:
-                base_name, extension = os.path.splitext(file_name)
-                max_base_name_length = min(259 - len(output_dir) - len(extension) - 1,
-                                           254 - len(extension) - 1)
-                base_name = base_name[:max_base_name_length]
-                file_name = base_name + extension
-                output_path = os.path.join(output_dir, file_name)
+    def extract_files(self, jobs):
+        for output_path, segment_indexes, checksum in jobs:
+            self.extract_file(output_path, segment_indexes, checksum)
 
-            segments = file.get("segm", [])
+    @staticmethod
+    def get_output_path(output_dir, file):
+        file_name = file.file_name
 
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        output_path = os.path.join(output_dir, file_name)
 
-            with open(output_path, 'wb') as f_out:
+        if len(output_path) > 260 or len(file_name) > 255:
+            base_name, extension = os.path.splitext(file_name)
+            max_base_name_length = min(259 - len(output_dir) - len(extension) - 1,
+                                       254 - len(extension) - 1)
+            base_name = base_name[:max_base_name_length]
+            file_name = base_name + extension
+            output_path = os.path.join(output_dir, file_name)
+        return output_path
+
+    @staticmethod
+    def coalesce_segments(segment_table, segment_indexes):
+        coalesced = []
+        for index in segment_indexes:
+            segment = segment_table[index]
+            if coalesced and not segment.compressed_flag:
+                previous = coalesced[-1]
+                if not previous.compressed_flag and previous.offset + previous.storage_size == segment.offset:
+                    coalesced[-1] = previous._replace(
+                        uncompressed_size=previous.uncompressed_size + segment.uncompressed_size,
+                        storage_size=previous.storage_size + segment.storage_size)
+                    continue
+            coalesced.append(segment)
+        return coalesced
+
+    def get_output_size(self, segment):
+        storage_size = max(0, min(segment.storage_size, len(self.xp3_data) - segment.offset))
+        if not segment.compressed_flag:
+            return storage_size
+        # Deflate cannot expand data by more than MAX_DEFLATE_RATIO, so larger recorded sizes are bogus.
+        return min(segment.uncompressed_size, storage_size * MAX_DEFLATE_RATIO)
+
+    def decompress_segment(self, segment):
+        offset = segment.offset
+        with memoryview(self.xp3_data)[offset:offset + segment.storage_size] as compressed_data:
+            return zlib.decompress(compressed_data, zlib.MAX_WBITS, self.get_output_size(segment))
+
+    def extract_file(self, output_path, segment_indexes, checksum=None):
+        segments = self.coalesce_segments(self.segment_table, segment_indexes)
+        adler32 = 1
+        with open(output_path, 'wb', buffering=0) as f_out:
+            file_size = sum(self.get_output_size(segment) for segment in segments)
+            preallocation_attempted = self.preallocate_file(f_out, file_size)
+            try:
+                buffers = []
+                buffered_size = 0
                 for segment in segments:
-                    offset = segment["offset"]
-                    storage_size = segment["storage_size"]
-                    is_compressed = segment["compressed_flag"]
-
-                    self.xp3_file.seek(offset)
-                    seg_data = self.xp3_file.read(storage_size)
-                    if is_compressed:
-                        seg_data = zlib.decompress(seg_data)
-                    f_out.write(seg_data)
+                    if checksum is not None and not segment.compressed_flag:
+                        offset = segment.offset
+                        with memoryview(self.xp3_data)[offset:offset + segment.storage_size] as stored_data:
+                            adler32 = zlib.adler32(stored_data, adler32)
+                    if segment.compressed_flag:
+                        buffer = self.decompress_segment(segment)
+                        if checksum is not None:
+                            adler32 = zlib.adler32(buffer, adler32)
+                    elif KERNEL_COPY_FUNCTIONS:
+                        write_buffers(f_out, buffers)
+                        buffered_size = 0
+                        buffer = self.copy_segment(segment, f_out)
+                    else:
+                        offset = segment.offset
+                        buffer = memoryview(self.xp3_data)[offset:offset + segment.storage_size]
+                    buffers.append(buffer)
+                    buffered_size += len(buffer)
+                    if buffered_size >= WRITE_BUFFER_SIZE:
+                        write_buffers(f_out, buffers)
+                        buffered_size = 0
+                write_buffers(f_out, buffers)
+            finally:
+                if preallocation_attempted:
+                    f_out.truncate()
+        if checksum is not None and adler32 != checksum:
+            raise ValueError('Invalid XP3 file checksum: ' + output_path)
+
+    @staticmethod
+    def preallocate_file(f_out, size):
+        if size < WRITE_BUFFER_SIZE or not hasattr(os, 'posix_fallocate'):
+            return False
+        try:
+            os.posix_fallocate(f_out.fileno(), 0, size)
+        except (OSError, OverflowError):
+            # A failed call may still have extended the file.
+            pass
+        return True
+
+    def copy_segment(self, segment, f_out):
+        offset = segment.offset
+        remaining = segment.storage_size
+        for kernel_copy in KERNEL_COPY_FUNCTIONS:
+            try:
+                while remaining > 0:
+                    copied = kernel_copy(self.xp3_file.fileno(), f_out.fileno(), self.xp3_offset + offset, remaining)
+                    if copied == 0:
+                        break
+                    offset += copied
+                    remaining -= copied
+            except OSError:
+                continue
+            break
+        return memoryview(self.xp3_data)[offset:offset + remaining]